@@ -3,7 +3,6 @@ import sys
 import operator
 from collections import namedtuple
 import os
-import string
 from datetime import datetime, timedelta
 from enum import Enum
 
@@ -86,7 +85,7 @@ class MidataReader(StatementReader):
         return Entry(date, amount, description, balance, self.account_name)
 
     def str_to_float(self, amount_str):
-        allowed = [".", "+", "-"] + list(string.digits)
+        allowed = ".+-0123456789"
         return float("".join(char for char in amount_str if char in allowed))
 
 
@@ -283,154 +282,565 @@ def is_week_start(dt):
     return dt.weekday() == 0
 
 
-def aggregate(statements, is_period_start, start_date, end_date):
+def get_periods(is_period_start, start_date, end_date):
     """
-    Look at entries between `start_date` and `end_dates` in the
-    AccountStatements in `statements`.
+    Split the days between `start_date` and `end_date` into time periods, where
+    is_period_start(day) is True iff day is the start of a period.
 
-    Aggregate entries by week/month/etc (is_period_start(day) should be
-    True iff day is the start of the time period) and categorise spending in
-    each period.
-
-    Return a list containing information for each time period of the form
-    {
-        "start": <start date as DD/MM/YY>,
-        "breakdown": {
-            "food": {"total": 20, "transactions": ["£10: Burger", ...]},
-            "drink": {...}
-            ...
-        }
-    }
+    Return a list of tuples (period_start, period_end). The first period may
+    start before `start_date`.
     """
-    aggregation = []
-    period = None
+    periods = []
+    one_day = timedelta(days=1)
 
     # Backtrack from start date to find start of period
     day = start_date
     while not is_period_start(day):
-        day -= timedelta(days=1)
+        day -= one_day
 
+    period_start = day
     while day <= end_date:
-        if is_period_start(day):
-            # Save previous period (if there was one) and reset
-            if period is not None:
-                aggregation.append(period)
-            period = {"start": day.strftime("%d/%m/%y"), "breakdown": {}}
+        next_day = day + one_day
+        if next_day > end_date or is_period_start(next_day):
+            periods.append((period_start, day))
+            period_start = next_day
+        day = next_day
 
-        for acc_st in statements:
-            # Day may not be in statement if we had to backtrack to find period
-            # start
-            if day in acc_st:
-                for e in acc_st[day]["entries"]:
-                    cat = "spending"  # TODO: use description to get category
-                    if cat not in period["breakdown"]:
-                        period["breakdown"][cat] = {
-                            "total": 0,
-                            "transactions": []
-                        }
-
-                    # Only care about spending
-                    if e.amount < 0:
-                        period["breakdown"][cat]["total"] -= e.amount
-                        transaction = "£{:.2f}: {}".format(-e.amount, e.description)
-                        period["breakdown"][cat]["transactions"].append(transaction)
-
-        day += timedelta(days=1)
-
-    aggregation.append(period)
-    return aggregation
+    return periods
 
 
-def usage():
-    prog = os.path.basename(sys.argv[0])
-    usage = """Usage: {} [-s]
+TRANSACTION_FORMAT = "£{:.2f}: {}"
 
-Read bank statements from subdirectories of 'statements' and produce an
-aggregated statement in CSV format.
 
-Options:
-  -s, --spending    Print a weekly spending report instead of a statement
-""".format(prog)
-    print(usage)
+def get_period_days(periods):
+    """
+    Return a list containing the list of days in each period in `periods`
+    """
+    offsets = []
+    period_days = []
+    for period_start, period_end in periods:
+        length = (period_end - period_start).days + 1
+        while len(offsets) < length:
+            offsets.append(timedelta(days=len(offsets)))
+        period_days.append([period_start + offset
+                            for offset in offsets[:length]])
+    return period_days
+
+
+def map_account(acc_index, acc_st, period_days, totals_only=False):
+    """
+    Map phase of aggregation: compute partial results for a single account.
+
+    Return a list containing a dict for each period mapping category to
+    {"first": <key>, "total": <total>, "refs": [<ref>, ...]}
+    where "first" is a tuple (date, acc_index, position) of the first entry in
+    the category, used to order categories when merging partials from
+    different accounts. Refs are tuples starting (date, amount, description)
+    in date order; here they are the Entry objects themselves. "refs" is left
+    empty when `totals_only` is True.
+    """
+    partials = []
+    for days in period_days:
+        breakdown = {}
+        for day in days:
+            # Day may not be in statement if we had to backtrack to find period
+            # start
+            info = acc_st.get(day)
+            if info is None:
+                continue
+            for pos, e in enumerate(info["entries"]):
+                cat = "spending"  # TODO: use description to get category
+                part = breakdown.get(cat)
+                if part is None:
+                    part = {"first": (day, acc_index, pos), "total": 0,
+                            "refs": []}
+                    breakdown[cat] = part
+
+                # Only care about spending
+                if e.amount < 0:
+                    part["total"] -= e.amount
+                    if not totals_only:
+                        part["refs"].append(e)
+        partials.append(breakdown)
+    return partials
+
+
+def make_shards(statements, period_days, totals_only=False, chunks=1):
+    """
+    Split the entries in `statements` that fall inside the periods in
+    `period_days` into shards for worker processes, with one shard for each
+    account and chunk of consecutive periods.
+
+    Shards only contain plain data so that they are cheap to send to worker
+    processes. Each shard is a tuple
+    (acc_index, first_period_index, period_rows, totals_only), where
+    `period_rows` contains a list for each period of rows
+    (date_ordinal, amount, description) in date order. Descriptions are left
+    out when `totals_only` is True.
+    """
+    chunk_size = max(1, -(-len(period_days) // chunks))
+    shards = []
+    for acc_index, acc_st in enumerate(statements):
+        for first in range(0, len(period_days), chunk_size):
+            period_rows = []
+            for days in period_days[first:first + chunk_size]:
+                rows = []
+                for day in days:
+                    info = acc_st.get(day)
+                    if info is None:
+                        continue
+                    ordinal = day.toordinal()
+                    for e in info["entries"]:
+                        description = None if totals_only else e.description
+                        rows.append((ordinal, e.amount, description))
+                period_rows.append(rows)
+            if any(period_rows):
+                shards.append((acc_index, first, period_rows, totals_only))
+    return shards
+
+
+def map_shard(shard):
+    """
+    Map phase of aggregation in a worker process: compute partial results for
+    a shard from `make_shards`.
 
+    Return a tuple (first_period_index, partials) where `partials` is in the
+    format returned by `map_account`, except that dates are ordinals and refs
+    are the rows themselves.
+    """
+    acc_index, first, period_rows, totals_only = shard
+    partials = []
+    for rows in period_rows:
+        breakdown = {}
+        prev_ordinal = None
+        for row in rows:
+            ordinal, amount, _ = row
+            pos = pos + 1 if ordinal == prev_ordinal else 0
+            prev_ordinal = ordinal
+
+            cat = "spending"  # TODO: use description to get category
+            part = breakdown.get(cat)
+            if part is None:
+                part = {"first": (ordinal, acc_index, pos), "total": 0,
+                        "refs": []}
+                breakdown[cat] = part
+
+            # Only care about spending
+            if amount < 0:
+                part["total"] -= amount
+                if not totals_only:
+                    part["refs"].append(row)
+        partials.append(breakdown)
+    return first, partials
+
+
+def reduce_partials(periods, partials, totals_only=False):
+    """
+    Reduce phase of aggregation: merge partial results into the aggregation
+    format described in `aggregate`.
+
+    `partials` is a list of tuples (first_period_index, period_partials), in
+    account order, where `period_partials` is in the format returned by
+    `map_account`. Each account's refs are already in date order, so ordering
+    them only merges sorted runs, and ties are kept in account order so the
+    result does not depend on the order in which workers finished.
+    """
+    merged = [{} for _ in periods]
+    for first, period_partials in partials:
+        for period_merged, breakdown in zip(merged[first:], period_partials):
+            for cat, part in breakdown.items():
+                cat_merged = period_merged.get(cat)
+                if cat_merged is None:
+                    period_merged[cat] = {"first": part["first"],
+                                          "total": part["total"],
+                                          "refs": [part["refs"]]}
+                    continue
+                if part["first"] < cat_merged["first"]:
+                    cat_merged["first"] = part["first"]
+                cat_merged["total"] += part["total"]
+                cat_merged["refs"].append(part["refs"])
+
+    format_transaction = TRANSACTION_FORMAT.format
+    aggregation = []
+    for (period_start, _), period_merged in zip(periods, merged):
+        breakdown = {}
+        for cat in sorted(period_merged,
+                          key=lambda c: period_merged[c]["first"]):
+            breakdown[cat] = {"total": period_merged[cat]["total"]}
+            if not totals_only:
+                ref_lists = period_merged[cat]["refs"]
+                refs = ref_lists[0]
+                if len(ref_lists) > 1:
+                    # Each list is already in date order, and sorting is
+                    # stable, so this just merges the runs and keeps ties in
+                    # account order
+                    refs = [ref for ref_list in ref_lists for ref in ref_list]
+                    refs.sort(key=operator.itemgetter(0))
+                breakdown[cat]["transactions"] = [
+                    format_transaction(-ref[1], ref[2]) for ref in refs
+                ]
+
+        aggregation.append({
+            "start": period_start.strftime("%d/%m/%y"),
+            "breakdown": breakdown
+        })
+    return aggregation
 
-if __name__ == "__main__":
 
-    spending_report = False
-    for arg in sys.argv[1:]:
-        if arg in ("-h", "--help"):
-            usage()
-            sys.exit(0)
-        elif arg in ("-s", "--spending"):
-            spending_report = True
+def aggregate(statements, is_period_start, start_date, end_date,
+              totals_only=False, workers=1):
+    """
+    Look at entries between `start_date` and `end_dates` in the
+    AccountStatements in `statements`.
+
+    Aggregate entries by week/month/etc (is_period_start(day) should be
+    True iff day is the start of the time period) and categorise spending in
+    each period.
+
+    Return a list containing information for each time period of the form
+    {
+        "start": <start date as DD/MM/YY>,
+        "breakdown": {
+            "food": {"total": 20, "transactions": ["£10: Burger", ...]},
+            "drink": {...}
+            ...
+        }
+    }
 
-    statements_dir = "statements"
+    If `totals_only` is True the "transactions" lists are omitted and
+    transactions are never formatted.
 
-    reader_config = {
-        NatwestReader: {
-            "dir": os.path.join(statements_dir, "natwest"),
-            "extension": "csv"
-        },
-        HsbcMidataReader: {
-            "dir": os.path.join(statements_dir, "hsbc"),
+    Shards of accounts and periods are mapped in worker processes when
+    `workers` is greater than 1.
+    """
+    periods = get_periods(is_period_start, start_date, end_date)
+    period_days = get_period_days(periods)
+
+    if workers > 1 and len(statements) > 1:
+        shards = make_shards(statements, period_days, totals_only=totals_only,
+                             chunks=workers)
+        # Only pay for importing multiprocessing machinery when it is used
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(shards) // (workers * 4))
+            partials = list(executor.map(map_shard, shards,
+                                         chunksize=chunksize))
+    else:
+        partials = [
+            (0, map_account(i, acc_st, period_days, totals_only=totals_only))
+            for i, acc_st in enumerate(statements)
+        ]
+
+    return reduce_partials(periods, partials, totals_only=totals_only)
+
+
+# Map bank name to a list of (reader class, config) tuples describing how to
+# read statements for that bank. Statements for each bank are looked for in a
+# subdirectory of the statements directory named after the bank
+READERS = {
+    "natwest": [
+        (NatwestReader, {"extension": "csv"})
+    ],
+    "hsbc": [
+        (HsbcMidataReader, {
             "extension": "midata",
             "open_kwargs": {"encoding": "utf-8-sig"}
-        },
-        HsbcCsvReader: {
-            "dir": os.path.join(statements_dir, "hsbc"),
+        }),
+        (HsbcCsvReader, {
             "extension": "csv",
             "open_kwargs": {"encoding": "utf-8-sig"}
-        },
-        SantanderReader: {
-            "dir": os.path.join(statements_dir, "santander"),
+        })
+    ],
+    "santander": [
+        (SantanderReader, {
             "extension": "csv",
             "open_kwargs": {"encoding": "ISO-8859-10"}
-        }
-    }
+        })
+    ]
+}
+
+
+def read_statement_file(reader_cls, config, filename):
+    """
+    Read a single statement file and return a list of AccountStatement objects
+    """
+    open_kwargs = config.get("open_kwargs", {})
+    with open(filename, newline="", **open_kwargs) as f:
+        reader = reader_cls(filename, f)
+        return get_statements(reader)
 
+
+def read_statements(statements_dir):
+    """
+    Read all statements found in subdirectories of `statements_dir` and extend
+    them to the latest available date.
+
+    Return a tuple (statements, start_date, end_date)
+    """
     statements = []
-    for reader_cls, config in reader_config.items():
-        d = config["dir"]
-        ext = ".{}".format(config["extension"])
-        filelist = (os.path.join(d, f) for f in os.listdir(d) if f.endswith(ext))
-        open_kwargs = config.get("open_kwargs", {})
-        for filename in filelist:
-            with open(filename, newline="", **open_kwargs) as f:
-                reader = reader_cls(filename, f)
-                statements += get_statements(reader)
+    for bank, readers in READERS.items():
+        d = os.path.join(statements_dir, bank)
+        if not os.path.isdir(d):
+            continue
+        for reader_cls, config in readers:
+            ext = ".{}".format(config["extension"])
+            filelist = (os.path.join(d, f) for f in os.listdir(d)
+                        if f.endswith(ext))
+            for filename in filelist:
+                statements += read_statement_file(reader_cls, config, filename)
+
+    if not statements:
+        sys.exit("no statements found in {}".format(statements_dir))
 
     # Ensure all statements go up to the latest available date
     start_date, end_date = get_date_range(statements)
     for acc_st in statements:
         acc_st.extend_balances(end_date)
 
-    if spending_report:
-        aggregation = aggregate(statements, is_week_start, start_date, end_date)
-        for period in aggregation:
-            print("Week beginning {}:".format(period["start"]))
-            for cat, breakdown in period["breakdown"].items():
-                print("  {}: £{:.2f}".format(cat, breakdown["total"]))
-                for tr in breakdown["transactions"]:
-                    print("    {}".format(tr))
+    return statements, start_date, end_date
 
-    else:
-        # Sort alphabetically just for display purposes
-        statements.sort(key=operator.attrgetter("name"))
 
-        # Print header row
-        row = ["Date"]
-        row += map(operator.attrgetter("name"), statements)
-        row.append("Total")
+def print_statement(statements, start_date, end_date):
+    # Sort alphabetically just for display purposes
+    statements = sorted(statements, key=operator.attrgetter("name"))
+
+    # Print header row
+    row = ["Date"]
+    row += map(operator.attrgetter("name"), statements)
+    row.append("Total")
+    print(",".join(row))
+
+    d = start_date
+    while d <= end_date:
+        todays_balances = [acc_st[d]["balance"] for acc_st in statements]
+        total = sum(todays_balances)
+
+        row = [d.strftime("%d-%m-%Y")]
+        row += map(str, todays_balances)
+        row.append(str(total))
         print(",".join(row))
 
-        d = start_date
-        while d <= end_date:
-            todays_balances = [acc_st[d]["balance"] for acc_st in statements]
-            total = sum(todays_balances)
+        d += timedelta(days=1)
 
-            row = [d.strftime("%d-%m-%Y")]
-            row += map(str, todays_balances)
-            row.append(str(total))
-            print(",".join(row))
 
-            d += timedelta(days=1)
+def print_spending_report(aggregation):
+    for period in aggregation:
+        print("Week beginning {}:".format(period["start"]))
+        for cat, breakdown in period["breakdown"].items():
+            print("  {}: £{:.2f}".format(cat, breakdown["total"]))
+            for tr in breakdown.get("transactions", []):
+                print("    {}".format(tr))
+
+
+def statement_command(args):
+    print_statement(*read_statements(args.dir))
+
+
+def spending_command(args):
+    statements, start_date, end_date = read_statements(args.dir)
+    aggregation = aggregate(statements, is_week_start, start_date, end_date,
+                            totals_only=args.totals, workers=args.jobs)
+    print_spending_report(aggregation)
+
+
+def import_command(args):
+    """
+    Check that statement files can be parsed and copy them into the
+    statements directory for the given bank. Nothing is copied unless every
+    file parses
+    """
+    import shutil
+
+    readers = READERS[args.bank]
+    dest_dir = os.path.join(args.dir, args.bank)
+    imports = []  # List of (filename, destination, statements) tuples
+    for filename in args.files:
+        for reader_cls, config in readers:
+            if filename.endswith(".{}".format(config["extension"])):
+                break
+        else:
+            exts = ", ".join(config["extension"] for _, config in readers)
+            sys.exit("{}: expected a file with extension {}".format(filename,
+                                                                    exts))
+
+        try:
+            statements = read_statement_file(reader_cls, config, filename)
+        except OSError as ex:
+            sys.exit("{}: could not read statement: {}".format(filename,
+                                                               ex.strerror))
+        except (ValueError, IndexError) as ex:
+            sys.exit("{}: could not parse statement: {}".format(filename, ex))
+        except StopIteration:
+            # Raised by readers that skip a header row in an empty file
+            statements = []
+
+        if not statements:
+            sys.exit("{}: no transactions found in statement".format(filename))
+
+        dest = os.path.join(dest_dir, os.path.basename(filename))
+        if any(dest == other_dest for _, other_dest, _ in imports):
+            sys.exit("{}: another file with the same name is being "
+                     "imported".format(filename))
+        if os.path.exists(dest):
+            if os.path.samefile(filename, dest):
+                dest = None  # File is already in the statements directory
+            elif not args.force:
+                sys.exit("{}: {} already exists (use --force to "
+                         "overwrite)".format(filename, dest))
+
+        imports.append((filename, dest, statements))
+
+    for filename, dest, statements in imports:
+        if dest is not None:
+            try:
+                os.makedirs(dest_dir, exist_ok=True)
+                shutil.copy(filename, dest)
+            except OSError as ex:
+                sys.exit("{}: could not copy to {}: {}".format(filename, dest,
+                                                               ex.strerror))
+
+        for acc_st in statements:
+            print("Imported {} days for '{}' from {}".format(
+                len(acc_st), acc_st.name, filename))
+
+
+def bench_command(args):
+    """
+    Time reading statements and producing each type of report
+    """
+    import contextlib
+    import io
+    import time
+
+    def timed(label, func, *func_args, **func_kwargs):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = func(*func_args, **func_kwargs)
+            times.append(time.perf_counter() - start)
+        print("{:<24} {:10.3f} ms".format(label, min(times) * 1000))
+        return result
+
+    statements, start_date, end_date = timed("read statements",
+                                             read_statements, args.dir)
+    timed("statement", print_statement, statements, start_date, end_date)
+    for totals_only in (False, True):
+        label = "spending{} (-j {})".format(" totals" if totals_only else "",
+                                           args.jobs)
+        timed(label, aggregate, statements, is_week_start, start_date,
+              end_date, totals_only=totals_only, workers=args.jobs)
+
+
+def expand_spending_alias(argv, commands):
+    """
+    Rewrite the deprecated -s/--spending flag in the argument list `argv` as
+    the spending subcommand, and return the new argument list.
+
+    The old interface had no subcommands, so the flag may appear anywhere.
+    Global options are moved before the subcommand so they are still
+    recognised. `argv` is returned unchanged if it already names one of
+    `commands`.
+    """
+    global_args = []
+    other_args = []
+    found = None
+    args = iter(argv)
+    for arg in args:
+        if arg in commands:
+            return argv
+        elif arg in ("-s", "--spending"):
+            found = arg
+        elif arg in ("-d", "--dir"):
+            global_args.append(arg)
+            value = next(args, None)
+            if value is not None:
+                global_args.append(value)
+        elif arg.startswith("--dir=") or (arg.startswith("-d") and
+                                          not arg.startswith("--")):
+            global_args.append(arg)
+        else:
+            other_args.append(arg)
+
+    if found is None:
+        return argv
+
+    print("warning: {} is deprecated, use 'spending' instead".format(found),
+          file=sys.stderr)
+    return global_args + ["spending"] + other_args
+
+
+def main(argv=None):
+    # argparse is only imported here rather than at module level so that
+    # importing bank as a library does not pay for it
+    import argparse
+
+    def positive_int(s):
+        try:
+            n = int(s)
+        except ValueError:
+            n = 0
+        if n < 1:
+            raise argparse.ArgumentTypeError(
+                "expected a positive integer, got {!r}".format(s)
+            )
+        return n
+
+    parser = argparse.ArgumentParser(
+        description="Read bank statements from subdirectories of a "
+                    "statements directory and produce aggregated reports."
+    )
+    parser.add_argument("-d", "--dir", default="statements",
+                        help="statements directory (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command")
+
+    statement_parser = subparsers.add_parser(
+        "statement", help="print an aggregated statement in CSV format "
+                          "(default)"
+    )
+    statement_parser.set_defaults(func=statement_command)
+
+    spending_parser = subparsers.add_parser(
+        "spending", help="print a weekly spending report"
+    )
+    spending_parser.add_argument("-t", "--totals", action="store_true",
+                                 help="only print totals")
+    spending_parser.add_argument("-j", "--jobs", type=positive_int, default=1,
+                                 help="number of worker processes to "
+                                      "aggregate with (default: %(default)s)")
+    spending_parser.set_defaults(func=spending_command)
+
+    import_parser = subparsers.add_parser(
+        "import", help="check statement files parse and copy them into the "
+                       "statements directory"
+    )
+    import_parser.add_argument("bank", choices=sorted(READERS))
+    import_parser.add_argument("files", nargs="+", metavar="file")
+    import_parser.add_argument("-f", "--force", action="store_true",
+                               help="overwrite existing statements with the "
+                                    "same name")
+    import_parser.set_defaults(func=import_command)
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="time reading statements and producing reports"
+    )
+    bench_parser.add_argument("-n", "--repeat", type=positive_int, default=5,
+                              help="number of timing runs; the best is "
+                                   "reported (default: %(default)s)")
+    bench_parser.add_argument("-j", "--jobs", type=positive_int, default=1,
+                              help="number of worker processes to "
+                                   "aggregate with (default: %(default)s)")
+    bench_parser.set_defaults(func=bench_command)
+
+    if argv is None:
+        argv = sys.argv[1:]
+    argv = expand_spending_alias(argv, subparsers.choices)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args.func = statement_command
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,29 @@
 from io import StringIO
 from datetime import datetime
 import operator
+import os
+import subprocess
+import sys
+
+import pytest
 
 from bank import (HsbcCsvReader, NatwestReader, MidataReader, Entry,
                   get_statements, AccountStatement, get_date_range, SortOrder,
-                  aggregate, is_week_start)
+                  aggregate, is_week_start, get_periods, get_period_days,
+                  make_shards, main)
+
 
+# Maximum time quick CLI invocations may spend importing modules that a bare
+# interpreter (`python -c pass`) does not import, as a multiple of the time
+# spent importing the bare interpreter's modules in the same process. The
+# median over a few runs measured 2.5-2.8 when this was set, and 3.7-4.2 with
+# the lazily imported modules below imported eagerly instead
+STARTUP_IMPORT_BUDGET_RATIO = 3.2
+
+# Modules that bank.py only imports when a command needs them. argparse
+# imports shutil itself, so shutil is only lazy for library imports of bank
+LAZY_MODULES = ["concurrent.futures", "contextlib", "multiprocessing"]
+LIBRARY_LAZY_MODULES = LAZY_MODULES + ["argparse", "re", "shutil"]
 
 d1 = datetime(year=2018, month=2, day=1)
 d2 = datetime(year=2018, month=2, day=2)
@@ -240,6 +258,225 @@ class TestReaders(object):
             }
         }]
 
-        got = aggregate(get_statements(FakeReader(e_list)), is_week_start,
-                        fri0, wed4)
+        statements = get_statements(FakeReader(e_list))
+        got = aggregate(statements, is_week_start, fri0, wed4)
+        assert got == expected
+
+        # Merging partials from parallel workers should give the same result
+        got = aggregate(statements, is_week_start, fri0, wed4, workers=2)
+        assert got == expected
+
+        # Transactions should be omitted when only totals are required
+        got = aggregate(statements, is_week_start, fri0, wed4,
+                        totals_only=True)
+        for period in expected:
+            for breakdown in period["breakdown"].values():
+                del breakdown["transactions"]
         assert got == expected
+
+    def test_make_shards(self):
+        e1 = Entry(d1, -1, "a", 0, "acc1")
+        e2 = Entry(d1, 2, "b", 0, "acc1")
+        e3 = Entry(d3, -3, "c", 0, "acc1")
+        e4 = Entry(d5, -4, "d", 0, "acc2")
+        statements = [
+            AccountStatement("acc1", {
+                d1: {"balance": 0, "entries": [e1, e2]},
+                d2: {"balance": 0, "entries": []},
+                d3: {"balance": 0, "entries": [e3]}
+            }),
+            AccountStatement("acc2", {
+                d5: {"balance": 0, "entries": [e4]},
+                # Entries outside the periods should not be included
+                d6: {"balance": 0, "entries": [e4]}
+            })
+        ]
+        period_days = get_period_days([(d1, d2), (d3, d4), (d5, d5)])
+
+        o1, o3, o5 = (d.toordinal() for d in (d1, d3, d5))
+        assert make_shards(statements, period_days, chunks=2) == [
+            (0, 0, [[(o1, -1, "a"), (o1, 2, "b")], [(o3, -3, "c")]], False),
+            (1, 2, [[(o5, -4, "d")]], False)
+        ]
+        assert make_shards(statements, period_days, totals_only=True,
+                           chunks=3) == [
+            (0, 0, [[(o1, -1, None), (o1, 2, None)]], True),
+            (0, 1, [[(o3, -3, None)]], True),
+            (1, 2, [[(o5, -4, None)]], True)
+        ]
+
+    def test_get_periods(self):
+        wed0 = datetime(year=2018, month=1, day=10)
+        mon1 = datetime(year=2018, month=1, day=15)
+        sun1 = datetime(year=2018, month=1, day=21)
+        mon2 = datetime(year=2018, month=1, day=22)
+        tues2 = datetime(year=2018, month=1, day=23)
+
+        expected = [
+            (datetime(year=2018, month=1, day=8),
+             datetime(year=2018, month=1, day=14)),
+            (mon1, sun1),
+            (mon2, tues2)
+        ]
+        assert get_periods(is_week_start, wed0, tues2) == expected
+
+
+class TestCli(object):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "bank.py")
+
+    def import_times(self, args, cwd=None):
+        """
+        Run python with `-X importtime` and the given arguments, and return a
+        dict mapping module name to self import time in microseconds
+        """
+        proc = subprocess.run([sys.executable, "-X", "importtime"] + args,
+                              cwd=cwd, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, universal_newlines=True,
+                              check=True)
+        times = {}
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            self_us, _, module = line[len("import time:"):].split("|")
+            if self_us.strip().isdigit():
+                times[module.strip()] = int(self_us)
+        return times
+
+    def test_startup_time(self, tmpdir):
+        statement = tmpdir.join("statement.csv")
+        statement.write('25/12/2017,My description here   VIS,"-50.65"\n')
+
+        invocations = [
+            ["--help"],
+            ["spending", "--help"],
+            ["-d", str(tmpdir.join("statements")), "import", "--force", "hsbc",
+             str(statement)]
+        ]
+
+        base_modules = set(self.import_times(["-c", "pass"]))
+        for args in invocations:
+            ratios = []
+            for _ in range(5):
+                times = self.import_times([self.script] + args,
+                                          cwd=str(tmpdir))
+                for mod in LAZY_MODULES:
+                    assert mod not in times, (mod, args)
+
+                # Compare against the bare interpreter's imports in the same
+                # process so the budget does not depend on the machine's speed
+                base = sum(t for mod, t in times.items()
+                           if mod in base_modules)
+                extra = sum(t for mod, t in times.items()
+                            if mod not in base_modules)
+                ratios.append(extra / base)
+            # Take the median to reduce noise from other processes
+            ratios.sort()
+            assert ratios[len(ratios) // 2] < STARTUP_IMPORT_BUDGET_RATIO, args
+
+        times = self.import_times(["-c", "import bank"],
+                                  cwd=os.path.dirname(self.script))
+        for mod in LIBRARY_LAZY_MODULES:
+            assert mod not in times, mod
+
+        assert tmpdir.join("statements", "hsbc", "statement.csv").check()
+
+    def make_statements_dir(self, tmpdir):
+        """
+        Create a statements directory containing a single HSBC statement and
+        return its path
+        """
+        statements_dir = tmpdir.mkdir("statements")
+        statements_dir.mkdir("hsbc").join("savings.csv").write("\n".join([
+            '25/12/2017,My description here   VIS,"-50.65"',
+            '20/12/2017,Other description   VIS,"25.00"',
+        ]) + "\n")
+        return str(statements_dir)
+
+    def test_spending_totals(self, tmpdir, capsys):
+        statements_dir = self.make_statements_dir(tmpdir)
+
+        main(["-d", statements_dir, "spending"])
+        out, _ = capsys.readouterr()
+        assert out == ("Week beginning 18/12/17:\n"
+                       "  spending: £0.00\n"
+                       "Week beginning 25/12/17:\n"
+                       "  spending: £50.65\n"
+                       "    £50.65: My description here   VIS\n")
+
+        main(["-d", statements_dir, "spending", "-t"])
+        out, _ = capsys.readouterr()
+        assert out == ("Week beginning 18/12/17:\n"
+                       "  spending: £0.00\n"
+                       "Week beginning 25/12/17:\n"
+                       "  spending: £50.65\n")
+
+    def test_deprecated_spending_flag(self, tmpdir, capsys):
+        statements_dir = self.make_statements_dir(tmpdir)
+        main(["-d", statements_dir, "spending", "-t"])
+        expected, _ = capsys.readouterr()
+
+        for argv in (["-d", statements_dir, "-s", "-t"],
+                     ["--spending", "-t", "-d", statements_dir],
+                     ["-t", "--dir=" + statements_dir, "-s"]):
+            main(argv)
+            out, err = capsys.readouterr()
+            assert out == expected
+            assert "deprecated" in err
+
+    def test_positive_int_options(self, tmpdir, capsys):
+        statements_dir = self.make_statements_dir(tmpdir)
+        for argv in (["spending", "-j", "0"], ["bench", "-n", "-1"],
+                     ["bench", "-j", "x"]):
+            with pytest.raises(SystemExit) as excinfo:
+                main(["-d", statements_dir] + argv)
+            assert excinfo.value.code == 2
+            _, err = capsys.readouterr()
+            assert "expected a positive integer" in err
+
+    def test_no_statements(self, tmpdir):
+        # Subdirectories for banks without statements do not need to exist
+        statements_dir = tmpdir.mkdir("statements")
+        with pytest.raises(SystemExit) as excinfo:
+            main(["-d", str(statements_dir)])
+        assert excinfo.value.code == ("no statements found in {}"
+                                      .format(statements_dir))
+
+    def test_import(self, tmpdir, capsys):
+        statements_dir = str(tmpdir.join("statements"))
+        good = tmpdir.join("good.csv")
+        good.write('25/12/2017,My description here   VIS,"-50.65"\n')
+        bad = tmpdir.join("bad.csv")
+        bad.write("25/12/2017,no amount\n")
+        empty = tmpdir.join("empty.midata")
+        empty.write("")
+        missing = tmpdir.join("missing.csv")
+
+        errors = [
+            (["natwest", str(empty)], "expected a file with extension csv"),
+            (["hsbc", str(good), str(bad)], "could not parse statement"),
+            (["hsbc", str(empty)], "no transactions found"),
+            (["hsbc", str(missing)], "could not read statement")
+        ]
+        for argv, message in errors:
+            with pytest.raises(SystemExit) as excinfo:
+                main(["-d", statements_dir, "import"] + argv)
+            assert message in excinfo.value.code
+        # Nothing should be copied unless every file parses
+        assert not tmpdir.join("statements").check()
+
+        main(["-d", statements_dir, "import", "hsbc", str(good)])
+        out, _ = capsys.readouterr()
+        assert out == "Imported 1 days for 'good.csv' from {}\n".format(good)
+        dest = tmpdir.join("statements", "hsbc", "good.csv")
+        assert dest.read() == good.read()
+
+        # Existing statements are only overwritten with --force
+        good.write('26/12/2017,Other description   VIS,"-1.00"\n')
+        with pytest.raises(SystemExit) as excinfo:
+            main(["-d", statements_dir, "import", "hsbc", str(good)])
+        assert "already exists" in excinfo.value.code
+        assert dest.read() != good.read()
+
+        main(["-d", statements_dir, "import", "--force", "hsbc", str(good)])
+        assert dest.read() == good.read()